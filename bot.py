@@ -1,3 +1,4 @@
+import math
 import os
 import string
 from collections.abc import Iterator
@@ -211,28 +212,163 @@ def attribute_matches(required: Optional[Union[StrictFloat, StrictInt]],
         return True
 
 
-def assign_skill_points(character: DungeonsandtrollsCharacter, api_instance: dnt.DungeonsAndTrollsApi) -> bool:
-    if character.skill_points == 0:
+# Attributes the optimizer may put skill points into.
+ASSIGNABLE_ATTRIBUTES = ["strength", "dexterity", "intelligence", "willpower", "constitution", "slash_resist",
+                         "pierce_resist", "fire_resist", "poison_resist", "electric_resist"]
+# Damage types we expect monsters to hit us with.
+SURVIVABILITY_RESISTS = ["slash_resist", "pierce_resist", "fire_resist"]
+# Resist at which half of the incoming damage of that type is avoided.
+RESIST_HALF_POINT = 10
+DAMAGE_WEIGHT = 1.0
+SURVIVABILITY_WEIGHT = 1.0
+# Value of meeting all requirements of one affordable shop item, while nothing is equipped yet.
+UNLOCK_WEIGHT = 0.1
+
+# Skills with their per point damage gain and shop item requirements, keyed by equipped item ids and
+# the affordable shop offer. They don't depend on the character attributes, so they survive assigning points,
+# and the value tables are rebuilt from them on every call with cheap arithmetic.
+equipment_profile_cache = {}
+EQUIPMENT_PROFILE_CACHE_SIZE = 32
+
+
+def attribute_value(attributes: DungeonsandtrollsAttributes, attr: string) -> float:
+    if attributes is None:
+        return 0
+    return getattr(attributes, attr, None) or 0
+
+
+# Skills which select_gear and fight would use to deal damage.
+def collect_damage_skills(items: list[DungeonsandtrollsItem]) -> list[DungeonsandtrollsSkill]:
+    return [skill for item in items for skill in item.skills
+            if skill.damage_type == DungeonsandtrollsDamageType.SLASH and skill.target == SkillTarget.CHARACTER]
+
+
+def compute_equipment_profile(skills: list[DungeonsandtrollsSkill], shop_items: list[DungeonsandtrollsItem]) -> \
+        tuple[list[DungeonsandtrollsSkill], list[dict[str, float]], list[dict[str, float]]]:
+    # damage is linear in attributes, so a single point in one attribute gives the per point gain
+    units = {attr: DungeonsandtrollsAttributes(**{name: 1 if name == attr else 0
+                                                  for name in DungeonsandtrollsAttributes.__fields__})
+             for attr in ASSIGNABLE_ATTRIBUTES}
+    slopes = [{attr: compute_damage(skill.damage_amount, unit) for attr, unit in units.items()} for skill in skills]
+    requirements = [{attr: attribute_value(item.requirements, attr) for attr in ASSIGNABLE_ATTRIBUTES
+                     if attribute_value(item.requirements, attr)}
+                    for item in shop_items]
+    return skills, slopes, [required for required in requirements if required]
+
+
+# Computes cumulative value of putting 0..points skill points into each attribute.
+# The marginal value of the k-th point is table[k] - table[k - 1]. Also returns the numbers of points
+# at which some shop item requirement gets met.
+def compute_marginal_value_tables(skills: list[DungeonsandtrollsSkill], slopes: list[dict[str, float]],
+                                  requirements: list[dict[str, float]], attributes: DungeonsandtrollsAttributes,
+                                  points: int) -> tuple[dict[str, list[float]], dict[str, list[int]]]:
+    base_damages = [compute_damage(skill.damage_amount, attributes) for skill in skills]
+    base_damage = max(base_damages, default=0)
+    tables = {}
+    threshold_steps = {}
+    for attr in ASSIGNABLE_ATTRIBUTES:
+        base = attribute_value(attributes, attr)
+        damage_lines = [(damage, slope[attr]) for damage, slope in zip(base_damages, slopes)]
+        # each item counts once, split between the attributes it requires
+        thresholds = []
+        for required in requirements:
+            required_here = required.get(attr, 0)
+            if base < required_here <= base + points:
+                thresholds.append((math.ceil(required_here - base), 1 / len(required)))
+        table = []
+        for k in range(points + 1):
+            value = 0.0
+            # log of damage and effective life, so their product gets maximized with diminishing returns
+            if damage_lines:
+                damage = max(start + gain * k for start, gain in damage_lines)
+                value += DAMAGE_WEIGHT * math.log((1 + damage) / (1 + base_damage))
+            if attr in SURVIVABILITY_RESISTS:
+                effective_life = (RESIST_HALF_POINT + base + k) / (RESIST_HALF_POINT + base)
+                value += SURVIVABILITY_WEIGHT * math.log(effective_life) / len(SURVIVABILITY_RESISTS)
+            value += UNLOCK_WEIGHT * sum(share for needed, share in thresholds if needed <= k)
+            table.append(value)
+        tables[attr] = table
+        threshold_steps[attr] = sorted(set(needed for needed, _ in thresholds))
+    return tables, threshold_steps
+
+
+def get_marginal_value_tables(character: DungeonsandtrollsCharacter, shop_items: list[DungeonsandtrollsItem],
+                              points: int) -> tuple[dict[str, list[float]], dict[str, list[int]]]:
+    # select_gear only buys while nothing is equipped, so afterwards there is nothing left to unlock
+    unlockable = []
+    if len(character.equip) == 0:
+        unlockable = [item for item in shop_items if item.price < character.money]
+    key = (frozenset(item.id for item in character.equip), frozenset(item.id for item in unlockable))
+    if key not in equipment_profile_cache:
+        if len(equipment_profile_cache) >= EQUIPMENT_PROFILE_CACHE_SIZE:
+            # drop the oldest profile
+            del equipment_profile_cache[next(iter(equipment_profile_cache))]
+        equipment_profile_cache[key] = compute_equipment_profile(collect_damage_skills(character.equip), unlockable)
+    skills, slopes, requirements = equipment_profile_cache[key]
+    return compute_marginal_value_tables(skills, slopes, requirements, character.attributes, points)
+
+
+# Greedily spends points on the best value per point. Jumps straight to requirement thresholds,
+# so items needing several points are not skipped just because a single point gains nothing.
+def allocate_skill_points(tables: dict[str, list[float]], threshold_steps: dict[str, list[int]],
+                          points: int) -> dict[str, int]:
+    allocation = {attr: 0 for attr in tables}
+    remaining = points
+    while remaining > 0:
+        best = None
+        for attr, table in tables.items():
+            spent = allocation[attr]
+            current = table[spent]
+            targets = [spent + 1] + [needed for needed in threshold_steps[attr] if needed > spent + 1]
+            for target in targets:
+                step = target - spent
+                if step > remaining or target >= len(table):
+                    break
+                gain = (table[spent + step] - current) / step
+                if best is None or gain > best[0]:
+                    best = (gain, attr, step)
+        if best is None:
+            break
+        _, attr, step = best
+        allocation[attr] += step
+        remaining -= step
+    return allocation
+
+
+def assign_skill_points(character: DungeonsandtrollsCharacter, shop_items: list[DungeonsandtrollsItem],
+                        api_instance: dnt.DungeonsAndTrollsApi) -> bool:
+    # only whole points can be assigned
+    points = int(character.skill_points or 0)
+    if points <= 0:
+        return False
+    print("Assigning skill points: "+str(points))
+    tables, threshold_steps = get_marginal_value_tables(character, shop_items, points)
+    allocation = allocate_skill_points(tables, threshold_steps, points)
+    allocated = sum(allocation.values())
+    if allocated <= 0:
         return False
-    print("Assigning skill points: "+str(character.skill_points))
-    skill_points_partial = 5
-    rest = character.skill_points - 5*3
-    # main_points = rest / 3
     attr: DungeonsandtrollsAttributes = DungeonsandtrollsAttributes(
-        strength=rest,
-        slash_resist=skill_points_partial,
-        pierce_resist=skill_points_partial,
-        fire_resist=skill_points_partial
+        **{name: value for name, value in allocation.items() if value}
     )
-    print("Assigning " + str(character.skill_points) + " skill points to " + attr.to_str())
+    print("Assigning " + str(allocated) + " skill points to " + attr.to_str())
     api_instance.dungeons_and_trolls_assign_skill_points(attr)
     return True
 
 
-def calculate_damage_multiplicator(damage_amount: DungeonsandtrollsAttributes) -> string:
-    for key in damage_amount.to_dict().keys():
-        if damage_amount.to_dict()[key]:
-            return key
+# Returns the attribute contributing the most to the damage, or the one with the biggest
+# coefficient if the character attributes are not known.
+def calculate_damage_multiplicator(damage_amount: DungeonsandtrollsAttributes,
+                                   character_attributes: DungeonsandtrollsAttributes = None) -> string:
+    contributions = {}
+    for key, value in damage_amount.to_dict().items():
+        if not value or key == "constant":
+            continue
+        if character_attributes is not None:
+            value = value * (getattr(character_attributes, key, None) or 0)
+        contributions[key] = value
+    if len(contributions) == 0:
+        return None
+    return max(contributions, key=contributions.get)
 
 
 def choose_healing_item(items: list[DungeonsandtrollsItem], budget: int,
@@ -284,15 +420,18 @@ def select_gear(items: list[DungeonsandtrollsItem],
     print("Selecting gear")
     budget = character.money
     # character will have at least strength 50 with all items
-    character.attributes.strength = 50
+    attributes = character.attributes.copy(update={"strength": 50})
     # choose slashing main weapon
-    item = choose_best_item(items, DungeonsandtrollsItemType.MAINHAND, character.attributes, budget,
+    item = choose_best_item(items, DungeonsandtrollsItemType.MAINHAND, attributes, budget,
                             DungeonsandtrollsDamageType.SLASH, SkillTarget.CHARACTER, None)
-    best_skill = select_damage_skill([item], character.attributes)
+    best_skill = select_damage_skill([item], attributes)
     damage_multiplicator = None
     if best_skill is not None:
-        damage_multiplicator = calculate_damage_multiplicator(best_skill.damage_amount)
-        print("Best skill: " + best_skill.name + " boosted by " + damage_multiplicator)
+        damage_multiplicator = calculate_damage_multiplicator(best_skill.damage_amount, attributes)
+        if damage_multiplicator is not None:
+            print("Best skill: " + best_skill.name + " boosted by " + damage_multiplicator)
+        else:
+            print("Best skill: " + best_skill.name + " has no scaling attribute")
     else:
         print("Can't find best skill")
     if item:
@@ -303,14 +442,14 @@ def select_gear(items: list[DungeonsandtrollsItem],
              DungeonsandtrollsItemType.NECK, DungeonsandtrollsItemType.LEGS]
 
     # choose charge item
-    charge_item = choose_charge_item(items, budget, character.attributes, slots)
+    charge_item = choose_charge_item(items, budget, attributes, slots)
     if charge_item:
         slots.remove(charge_item.slot)
         gear.ids.append(charge_item.id)
         budget = budget - charge_item.price
 
     # choose healing item
-    healing_item = choose_healing_item(items, budget, character.attributes, slots)
+    healing_item = choose_healing_item(items, budget, attributes, slots)
     if healing_item:
         slots.remove(healing_item.slot)
         gear.ids.append(healing_item.id)
@@ -318,7 +457,7 @@ def select_gear(items: list[DungeonsandtrollsItem],
 
     # choose other items in empty slots which boost the main weapon
     for slot in slots:
-        item = choose_best_item(items, slot, character.attributes, budget, None, None,
+        item = choose_best_item(items, slot, attributes, budget, None, None,
                                 damage_multiplicator)
         if item:
             gear.ids.append(item.id)
@@ -602,13 +741,16 @@ def main():
                 game = api_instance.dungeons_and_trolls_game()
                 print("current level", game.current_level)
 
-                if assign_skill_points(game.character, api_instance):
+                # buy and equip items, skill points are assigned once the new gear shows up in the game state
+                gear = select_gear(game.shop_items, game.character)
+                if len(gear.ids) > 0:
+                    maybe_buy_gear(gear, api_instance)
                     continue
-
-                # buy and equip items
-                maybe_buy_gear(select_gear(game.shop_items, game.character), api_instance)
                 print_skills(game.character.equip)
 
+                if assign_skill_points(game.character, game.shop_items, api_instance):
+                    continue
+
                 # print("respawn")
                 # api_instance.dungeons_and_trolls_respawn({})
                 # continue